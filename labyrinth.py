@@ -2,14 +2,17 @@ import abc
 import random
 import itertools
 import json
+import functools
 
-from collections import deque, defaultdict
+from collections import defaultdict
 from typing import Union, Callable
 from dataclasses import dataclass
 from enum import Enum, Flag, auto
 
 
 class Serializable(abc.ABC):
+	__slots__ = ()
+
 	def to_json(self):
 		return NotImplemented
 
@@ -18,8 +21,6 @@ class CustomJson(json.JSONEncoder):
 	def default(self, obj):
 		if isinstance(obj, Serializable):
 			return obj.to_json()
-		if isinstance(obj, deque):
-			return list(obj)
 		return json.JSONEncoder.default(self, obj)
 
 
@@ -45,14 +46,23 @@ class Direction(Flag):
 	NSEW = NORTH | SOUTH | EAST | WEST
 
 	def __lshift__(self, amount):
-		amount %= 4
-		rotated = self.value << amount
-		return Direction(rotated & 0xF | (rotated & 0xF0) >> 4)
+		return _ROT[amount % 4][self.value]
 
 	def __rshift__(self, amount):
 		return self.__lshift__(-amount)
 
 
+# _ROT[amount][value] is the Direction with that value rotated clockwise.
+_ROT = [
+	[Direction((value << amount) & 0xF | ((value << amount) & 0xF0) >> 4) for value in range(16)]
+	for amount in range(4)
+]
+
+# Raw values for tests in hot paths, to avoid building Flag intermediates.
+NW_MASK = Direction.NW.value
+EW_MASK = Direction.EW.value
+
+
 class Quest(Enum):
 	BAT = 'A'
 	BOOK = 'B'
@@ -93,7 +103,26 @@ class Color(Enum):
 		return f"{self.name} start ({self.value})"
 
 
-@dataclass
+# The box around a tile only depends on its path, and there are only 16 paths.
+@functools.lru_cache(maxsize=None)
+def _box_drawing_parts(path):
+	north = '╨' if path & Direction.NORTH.value else '─'
+	west = '═╡' if path & Direction.WEST.value else ' │'
+	east = '╞═' if path & Direction.EAST.value else '│ '
+	south = '╥' if path & Direction.SOUTH.value else '─'
+	return f" ╭─{north}─╮ ", west, east, f" ╰─{south}─╯ "
+
+
+# Tile JSON is shared between equal tiles; the encoder only reads it.
+@functools.lru_cache(maxsize=None)
+def _tile_json(path, item):
+	return {
+		'paths': [d.name for d in Direction(path)],
+		'item': item,
+	}
+
+
+@dataclass(slots=True)
 class Tile(Serializable):
 	path: Direction
 	item: Union[Quest, Color, None]
@@ -106,31 +135,37 @@ class Tile(Serializable):
 		return f"{self.path.name} {self.item}"
 
 	def box_drawing_lines(self, symbol=None):
-		north = '╨' if self.path & Direction.NORTH else '─'
-		west = '═╡' if self.path & Direction.WEST else ' │'
-		east = '╞═' if self.path & Direction.EAST else '│ '
-		south = '╥' if self.path & Direction.SOUTH else '─'
+		top, west, east, bottom = _box_drawing_parts(self.path.value)
 		if symbol is None:
 			symbol = self.symbol
 		return [
-			f" ╭─{north}─╮ ",
+			top,
 			f"{west}{symbol:^3}{east}",
-			f" ╰─{south}─╯ ",
+			bottom,
 		]
 
 	def to_json(self):
-		return {
-			'paths': [d.name for d in self.path],
-			'item': None if not self.item else self.item.name,
-		}
+		return _tile_json(self.path.value, None if not self.item else self.item.name)
+
+
+# The board is always 7x7, so rotations are unrolled rather than using deques.
+def rotate_row(row, sign):
+	if sign == 1:
+		row[0], row[1], row[2], row[3], row[4], row[5], row[6] = \
+			row[6], row[0], row[1], row[2], row[3], row[4], row[5]
+	else:
+		row[0], row[1], row[2], row[3], row[4], row[5], row[6] = \
+			row[1], row[2], row[3], row[4], row[5], row[6], row[0]
 
 
 def rotate_column(grid, index, sign):
-	# maybe not most efficient space-wise... but really short!
-	col = deque(row[index] for row in grid)
-	col.rotate(sign)
-	for row, v in zip(grid, col):
-		row[index] = v
+	r0, r1, r2, r3, r4, r5, r6 = grid
+	if sign == 1:
+		r0[index], r1[index], r2[index], r3[index], r4[index], r5[index], r6[index] = \
+			r6[index], r0[index], r1[index], r2[index], r3[index], r4[index], r5[index]
+	else:
+		r0[index], r1[index], r2[index], r3[index], r4[index], r5[index], r6[index] = \
+			r1[index], r2[index], r3[index], r4[index], r5[index], r6[index], r0[index]
 
 
 def chunks(items, n):
@@ -138,19 +173,41 @@ def chunks(items, n):
 		yield items[i:i + n]
 
 
+# Fixed tiles occur where both coordinates are even; the rest are loose.
+FIXED_TILES = {
+	(0, 0): (Direction.SE, Color.RED),
+	(0, 2): (Direction.SEW, Quest.BOOK),
+	(0, 4): (Direction.SEW, Quest.POUCH),
+	(0, 6): (Direction.SW, Color.YELLOW),
+	(2, 0): (Direction.NSE, Quest.MAP),
+	(2, 2): (Direction.NSE, Quest.CROWN),
+	(2, 4): (Direction.SEW, Quest.KEYS),
+	(2, 6): (Direction.NSW, Quest.SKULL),
+	(4, 0): (Direction.NSE, Quest.RING),
+	(4, 2): (Direction.NEW, Quest.CHEST),
+	(4, 4): (Direction.NSW, Quest.EMERALD),
+	(4, 6): (Direction.NSW, Quest.SWORD),
+	(6, 0): (Direction.NE, Color.GREEN),
+	(6, 2): (Direction.NEW, Quest.CANDELABRA),
+	(6, 4): (Direction.NEW, Quest.HELMET),
+	(6, 6): (Direction.NW, Color.BLUE),
+}
+
+
 PLAYER_START = {
 	Color.RED: (0, 0),
-	Color.YELLOW: (0, 7),
-	Color.GREEN: (7, 0),
-	Color.BLUE: (7, 7),
+	Color.YELLOW: (0, 6),
+	Color.GREEN: (6, 0),
+	Color.BLUE: (6, 6),
 }
 
 
-@dataclass
+@dataclass(slots=True)
 class Player(Serializable):
 	client: Callable
 	color: Color
-	items: deque[Quest]
+	# Remaining targets in reverse, so the current one is last.
+	items: list[Union[Quest, Color]]
 	i: int
 	j: int
 
@@ -158,7 +215,7 @@ class Player(Serializable):
 		self.client(self, game)
 		# self.client(JSON.encode({
 		# 	'color': self.color.name,
-		# 	'quest': self.items[0].name,
+		# 	'quest': self.items[-1].name,
 		# 	'players': {p.color.name: p for p in game.players},
 		# 	'board': game.board,
 		# }))
@@ -173,48 +230,6 @@ class Player(Serializable):
 class Game:
 
 	def __init__(self, players: list[tuple[Color, Callable]]):
-		self.board = [
-			[
-				Tile(Direction.SE, Color.RED),
-				None,
-				Tile(Direction.SEW, Quest.BOOK),
-				None,
-				Tile(Direction.SEW, Quest.POUCH),
-				None,
-				Tile(Direction.SW, Color.YELLOW),
-			],
-			deque([None] * 7),
-			[
-				Tile(Direction.NSE, Quest.MAP),
-				None,
-				Tile(Direction.NSE, Quest.CROWN),
-				None,
-				Tile(Direction.SEW, Quest.KEYS),
-				None,
-				Tile(Direction.NSW, Quest.SKULL),
-			],
-			deque([None] * 7),
-			[
-				Tile(Direction.NSE, Quest.RING),
-				None,
-				Tile(Direction.NEW, Quest.CHEST),
-				None,
-				Tile(Direction.NSW, Quest.EMERALD),
-				None,
-				Tile(Direction.NSW, Quest.SWORD),
-			],
-			deque([None] * 7),
-			[
-				Tile(Direction.NE, Color.GREEN),
-				None,
-				Tile(Direction.NEW, Quest.CANDELABRA),
-				None,
-				Tile(Direction.NEW, Quest.HELMET),
-				None,
-				Tile(Direction.NW, Color.BLUE),
-			],
-		]
-
 		loose_tiles = [
 			Tile(Direction.NEW, Quest.BAT),
 			Tile(Direction.NEW, Quest.DRAGON),
@@ -233,23 +248,30 @@ class Game:
 		]
 
 		random.shuffle(loose_tiles)
+		# draw every rotation at once, two bits per tile
+		rotations = random.getrandbits(2 * len(loose_tiles))
 		for tile in loose_tiles:
-			tile.path <<= random.randint(0, 3)
+			tile.path = _ROT[rotations & 3][tile.path.value]
+			rotations >>= 2
 
-		for i in range(7):
-			for j in range(7):
-				if i % 2 or j % 2:  # non-fixed tiles occur when either coordinate is odd
-					self.board[i][j] = loose_tiles.pop()
+		self.board = [
+			[Tile(*FIXED_TILES[i, j]) if (i, j) in FIXED_TILES else loose_tiles.pop() for j in range(7)]
+			for i in range(7)
+		]
 
 		self.free = loose_tiles.pop()
 
-		self.graph = compute_graph(self.board)
+		# Bitboards of the board tiles' paths, kept in sync with the board.
+		self.paths = path_bitboards(self.board)
+		self.graph, self.components = compute_graph(self.paths)
 
 		deck = list(Quest)
 		random.shuffle(deck)
 		self.players = []
 		for (color, client), items in zip(players, chunks(deck, 24 // len(players))):
+			# finish by returning to the start tile
 			items.append(color)
+			items.reverse()
 			self.players.append(Player(client, color, items, *PLAYER_START[color]))
 
 		self.winners = []
@@ -259,23 +281,30 @@ class Game:
 		if not index % 2:
 			raise ValueError(f"board is fixed at row/col {index}")
 
-		self.free.path <<= rotation
+		self.free.path = _ROT[rotation % 4][self.free.path.value]
+		inserted = self.free.path.value
 
-		if direction & Direction.NW:
+		if direction.value & NW_MASK:
 			eject_index = 0
 			sign = 1
 		else:
 			eject_index = 6
 			sign = -1
 
-		if direction & Direction.EW:
+		horizontal = direction.value & EW_MASK
+		if horizontal:
 			row = self.board[index]
-			row.rotate(sign)
+			rotate_row(row, sign)
 			self.free, row[eject_index] = row[eject_index], self.free
 		else:
 			rotate_column(self.board, index, sign)
 			self.free, self.board[eject_index][index] = self.board[eject_index][index], self.free
-		self.graph = compute_graph(self.board)
+		self.paths = tuple(
+			shift_bitboard(bits, horizontal, index, sign, inserted >> k & 1)
+			for k, bits in enumerate(self.paths)
+		)
+		self.graph, self.components = compute_graph(
+			self.paths, self.graph, self.components, shift_dirty_mask(horizontal, index))
 
 	def print_board(self, symbol=None):
 		if symbol is None:
@@ -286,11 +315,12 @@ class Game:
 				print(''.join(lines))
 
 	def print_sectors(self):
-		def sector(adj):
-			si, sj = min(adj)
+		def sector(label):
+			# component ids are already the index of their first cell
+			si, sj = CELLS[label]
 			return f"{si},{sj}"
 
-		sectors = {node: sector(adj) for node, adj in self.graph.items()}
+		sectors = {CELLS[cell]: sector(label) for cell, label in enumerate(self.graph)}
 		self.print_board(lambda i, j, _: sectors[(i, j)])
 
 	def print_free(self):
@@ -304,76 +334,147 @@ class Game:
 		for player in itertools.cycle(self.players):
 			if player.items:
 				direction, index, rotation, i, j = player.client(self)
-				last_dir, last_index, *_ = game.move_history[-1]
-				if direction == last_dir << 2 and index == last_index:
-					raise ValueError("Can't reverse last move")
-				game.shift(direction, index, rotation)
-				if (i, j) not in game.graph[(player.i, player.j)]:
+				if self.move_history:
+					last_dir, last_index, *_ = self.move_history[-1]
+					if direction == last_dir << 2 and index == last_index:
+						raise ValueError("Can't reverse last move")
+				if not (0 <= i < 7 and 0 <= j < 7):
+					raise ValueError(f"{i},{j} is not on the board")
+				self.shift(direction, index, rotation)
+				if self.graph[i * 7 + j] != self.graph[player.i * 7 + player.j]:
 					raise ValueError(f"{player.color} can't move to {i},{j}")
 				player.i = i
 				player.j = j
-				game.move_history.append((direction, index, rotation, i, j))
-				if game.board[i][j].item == player.items[0]:
-					player.items.popleft()
+				self.move_history.append((direction, index, rotation, i, j))
+				if self.board[i][j].item == player.items[-1]:
+					player.items.pop()
 					if not player.items:
-						game.winners.append(player.color)
-						if len(game.winners) == len(game.players) - 1:
+						self.winners.append(player.color)
+						if len(self.winners) == len(self.players) - 1:
 							return
 
 
-NAVIGATION = [
-	(Direction.NORTH, -1, 0),
-	(Direction.EAST, 0, 1),
-	(Direction.SOUTH, 1, 0),
-	(Direction.WEST, 0, -1),
-]
-
-
-def get_adjacent(board, i, j):
-	tile = board[i][j]
-	for dir_, di, dj in NAVIGATION:
-		ai = i + di
-		aj = j + dj
-		if tile.path & dir_ and 0 <= ai < 7 and 0 <= aj < 7:
-			if board[ai][aj].path & (dir_ << 2):
-				yield ai, aj
-
-
-def traverse(board, i, j, explored):
-	explored.add((i, j))
-	for adj in get_adjacent(board, i, j):
-		if adj not in explored:
-			ci, cj = adj
-			traverse(board, ci, cj, explored)
+# Bitboards use one bit per cell, indexed by i * 7 + j. Paths are kept as a
+# tuple of four bitboards in Direction bit order (north, east, south, west),
+# with a bit set if that cell's tile is open in that direction.
+FULL_BOARD = (1 << 49) - 1
+ROW_MASK = (1 << 7) - 1
+COLUMN_MASK = sum(1 << i * 7 for i in range(7))
+# Coordinates of each bit index.
+CELLS = [divmod(cell, 7) for cell in range(49)]
 
 
-def compute_graph(board):
-	graph = {}
+def path_bitboards(board):
+	paths = [0, 0, 0, 0]
 	for i in range(7):
 		for j in range(7):
-			if (i, j) not in graph:
-				explored = set()
-				traverse(board, i, j, explored)
-				for node in explored:
-					graph[node] = explored
-	return graph
+			path = board[i][j].path.value
+			for k in range(4):
+				if path >> k & 1:
+					paths[k] |= 1 << (i * 7 + j)
+	return tuple(paths)
+
+
+# Moves one path bitboard the same way shift() moves the board.
+def shift_bitboard(bits, horizontal, index, sign, inserted):
+	if horizontal:
+		line = ROW_MASK << index * 7
+		step = 1
+		first = index * 7
+		last = index * 7 + 6
+	else:
+		line = COLUMN_MASK << index
+		step = 7
+		first = index
+		last = index + 42
+	if sign == 1:
+		moved = (bits & line) << step & line | inserted << first
+	else:
+		moved = (bits & line) >> step & line | inserted << last
+	return bits & ~line | moved
+
+
+# The shifted line and its neighbors, the only cells that can change component.
+def shift_dirty_mask(horizontal, index):
+	if horizontal:
+		return (ROW_MASK | ROW_MASK << 7 | ROW_MASK << 14) << (index - 1) * 7
+	return (COLUMN_MASK | COLUMN_MASK << 1 | COLUMN_MASK << 2) << index - 1
+
+
+# Bitboards of cells connected to their neighbor in each direction; never wraps.
+def path_masks(paths):
+	north, east, south, west = paths
+	east_pairs = east & west >> 1 & ~(COLUMN_MASK << 6)
+	south_pairs = south & north >> 7
+	return south_pairs << 7, east_pairs, south_pairs, east_pairs << 1
+
+
+# Returns (graph, components), re-flooding only components with a dirty cell.
+def compute_graph(paths, graph=None, components=None, dirty=FULL_BOARD):
+	north, east, south, west = path_masks(paths)
+	if graph is None:
+		graph = bytearray(49)
+		components = {}
+		unvisited = FULL_BOARD
+	else:
+		graph = bytearray(graph)
+		components = dict(components)
+		stale = {graph[cell] for cell in range(49) if dirty >> cell & 1}
+		unvisited = 0
+		for label in stale:
+			for cell in components.pop(label):
+				unvisited |= 1 << cell
+	while unvisited:
+		seed = unvisited & -unvisited
+		component = seed
+		while True:
+			expanded = (
+				component
+				| (component & north) >> 7
+				| (component & east) << 1
+				| (component & south) << 7
+				| (component & west) >> 1
+			)
+			if expanded == component:
+				break
+			component = expanded
+		unvisited &= ~component
+		label = seed.bit_length() - 1
+		cells = []
+		while component:
+			low = component & -component
+			cell = low.bit_length() - 1
+			graph[cell] = label
+			cells.append(cell)
+			component ^= low
+		components[label] = tuple(cells)
+	return graph, components
+
+
+ALL_MOVES = tuple(itertools.product([1, 3, 5], Direction))
 
 
 def random_player(game, player):
-	moves = set(itertools.product([1, 3, 5], Direction))
 	if game.move_history:
-		moves.remove(game.move_history[-1][:2])
-	return random.choice(list(moves)), random.choice(list(game.graph[(player.i, player.j)]))
-
-
-game = Game([(Color.RED, print), (Color.BLUE, print)])
-game.print_board()
-print('REMAINING:')
-game.print_free()
-game.print_sectors()
-# game.shift(Direction.SOUTH, 1, 0)
-# print('AFTER SHIFT')
-# game.print_board()
-# game.print_free()
-# game.print_sectors()
-print(random_player(game, game.players[0]))
+		last_dir, last_index, *_ = game.move_history[-1]
+		reverse = (last_index, last_dir << 2)
+	else:
+		reverse = None
+	move = random.choice(ALL_MOVES)
+	while move == reverse:
+		move = random.choice(ALL_MOVES)
+	return move, CELLS[random.choice(game.components[game.graph[player.i * 7 + player.j]])]
+
+
+if __name__ == '__main__':
+	game = Game([(Color.RED, print), (Color.BLUE, print)])
+	game.print_board()
+	print('REMAINING:')
+	game.print_free()
+	game.print_sectors()
+	# game.shift(Direction.SOUTH, 1, 0)
+	# print('AFTER SHIFT')
+	# game.print_board()
+	# game.print_free()
+	# game.print_sectors()
+	print(random_player(game, game.players[0]))